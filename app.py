@@ -1,29 +1,59 @@
 import streamlit as st
 import pandas as pd
-import sqlite3
+import numpy as np
+import pyarrow as pa
+import xlsxwriter
 import plotly.express as px
 import io
+import functools
 import hashlib
+import hmac
 import os
+import sqlite3
 from datetime import datetime
+from sqlalchemy import create_engine, event
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 
 
 # ====== DATABASE CONNECTION ======
 DB_PATH = "elta.db"
 DB_URL = os.getenv("DATABASE_URL")
 
+# Лимит параметров в одном SQL-выражении SQLite, если сборку нельзя спросить (старые версии)
+SQLITE_MAX_VARIABLES = 999
+
+# Строк в одном многострочном INSERT (SQLite)
+SQLITE_INSERT_CHUNK_ROWS = 10_000
+
 # Исправляем URL для PostgreSQL
 if DB_URL and DB_URL.startswith("postgres://"):
     DB_URL = DB_URL.replace("postgres://", "postgresql://", 1)
 
 
-def get_conn():
-    """Возвращает соединение с БД (SQLite или PostgreSQL)"""
+@st.cache_resource
+def get_engine():
+    """Общий на процесс пул соединений (SQLite или PostgreSQL)"""
     if DB_URL:
-        import psycopg2
-        return psycopg2.connect(DB_URL, sslmode='require')
-    else:
-        return sqlite3.connect(DB_PATH, check_same_thread=False)
+        return create_engine(DB_URL, pool_size=5, pool_pre_ping=True,
+                             connect_args={"sslmode": "require"})
+    
+    engine = create_engine(f"sqlite:///{DB_PATH}", connect_args={"check_same_thread": False})
+    
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        # WAL + NORMAL: меньше fsync на каждую запись
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.close()
+    
+    return engine
+
+
+def get_conn():
+    """Возвращает DBAPI-соединение из пула; close() возвращает его в пул"""
+    return get_engine().raw_connection()
 
 
 def execute_query(query, params=None, fetch=True):
@@ -31,25 +61,24 @@ def execute_query(query, params=None, fetch=True):
     Универсальная функция для выполнения SQL-запросов.
     Автоматически адаптирует синтаксис для SQLite/PostgreSQL.
     """
-    conn = get_conn()
-    
     # Заменяем %s на ? для SQLite
     if not DB_URL:
         query = query.replace("%s", "?")
     
+    if fetch:
+        # SELECT запросы - возвращаем DataFrame
+        with get_engine().connect() as conn:
+            return pd.read_sql(query, conn, params=params, dtype_backend="pyarrow")
+    
+    # INSERT/UPDATE/DELETE - выполняем и коммитим
+    conn = get_conn()
     try:
-        if fetch:
-            # SELECT запросы - возвращаем DataFrame
-            df = pd.read_sql(query, conn, params=params)
-            return df
-        else:
-            # INSERT/UPDATE/DELETE - выполняем и коммитим
-            cursor = conn.cursor()
-            cursor.execute(query, params or ())
-            conn.commit()
-            lastrowid = cursor.lastrowid if hasattr(cursor, 'lastrowid') else None
-            cursor.close()
-            return lastrowid
+        cursor = conn.cursor()
+        cursor.execute(query, params or ())
+        conn.commit()
+        lastrowid = cursor.lastrowid if hasattr(cursor, 'lastrowid') else None
+        cursor.close()
+        return lastrowid
     finally:
         conn.close()
 
@@ -99,38 +128,111 @@ TZ_FIELDS_31 = [
 
 DEFAULT_FILTER_FIELDS = ["Год", "Месяц", "Регион", "Поставщик", "Сеть"]
 
-DEFAULT_NUMERIC_FIELDS = [
+DEFAULT_NUMERIC_FIELDS = frozenset({
     "Закупки_колво", "Закупки_сумма", "Продажи_колво", "Продажи_сумма", "Остатки_колво",
     "Глюкометры", "Глюкометр_Сателлит", "Глюкометр_Плюс", "Глюкометр_Экспресс",
     "Тест_полоски_50", "ТП_Сателлит_50", "ТП_Плюс_50", "ТП_Экспресс_50",
     "Тест_полоски_25", "ТП_Сателлит_25", "ТП_Плюс_25", "ТП_Экспресс_25",
-]
+})
+
+# Служебные колонки data (не редактируются и не фильтруются)
+SYSTEM_FIELDS = frozenset({"id", "upload_id", "uploaded_by", "uploaded_at"})
+
+# Поля, которые нельзя удалить из registry
+PROTECTED_FIELDS = SYSTEM_FIELDS | {"Год", "Месяц", "Код_клиента"}
+
+# Текстовые поля с малым числом различных значений — храним как category
+CATEGORY_FIELDS = ["Регион", "Поставщик", "Поставщик_общий", "Сеть", "Федеральный_округ", "Юр_лицо"]
+
+# При чтении для дашборда category получают ещё и Год/Месяц (частые фильтры)
+DASHBOARD_CATEGORY_FIELDS = CATEGORY_FIELDS + ["Год", "Месяц"]
+
+# Заголовки, по которым файл считается размеченным (иначе колонки берутся по позиции)
+YEAR_HEADERS = frozenset({"год", "year"})
+
+# Заголовки Excel -> имена полей
+COLUMN_RENAMES = {
+    "Код клиента": "Код_клиента",
+    "Наименование товара клиента": "Наименование_товара_клиента",
+    "Поставщик общий": "Поставщик_общий",
+    "Юридическое лицо": "Юр_лицо",
+    "Адрес аптеки": "Адрес_аптеки",
+    "Федеральный округ": "Федеральный_округ",
+    "Артикул Элта": "Артикул_Элта",
+    "Полное наименование Элта": "Полное_наименование_Элта",
+    "Региональный менеджер": "Региональный_менеджер",
+    "Медицинский представитель": "Медицинский_представитель",
+    "Закупки Кол-во упаковок": "Закупки_колво",
+    "Закупки кол-во упаковок": "Закупки_колво",
+    "Закупки сумма в закупочных ценах": "Закупки_сумма",
+    "Продажи кол-во упаковок": "Продажи_колво",
+    "Продажи сумма в закупочных ценах": "Продажи_сумма",
+    "Продажи сумма в закупочных ценах/ценах реализации": "Продажи_сумма",
+    "Остатки кол-во упаковок": "Остатки_колво",
+    "Тест-полоски 50": "Тест_полоски_50",
+    "Тест-полоски 25": "Тест_полоски_25",
+}
 
 
 def sha256(s: str) -> str:
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
 
+_password_hasher = PasswordHasher()
+
+
+def hash_password(password: str) -> str:
+    return _password_hasher.hash(password)
+
+
+def verify_password(stored_hash: str, password: str) -> bool:
+    """Проверка пароля; старые хэши (голый sha256) тоже принимаются"""
+    if not stored_hash.startswith("$argon2"):
+        return hmac.compare_digest(stored_hash, sha256(password))
+    try:
+        return _password_hasher.verify(stored_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+def password_needs_rehash(stored_hash: str) -> bool:
+    """True для старых sha256-хэшей и argon2 с устаревшими параметрами"""
+    return not stored_hash.startswith("$argon2") or _password_hasher.check_needs_rehash(stored_hash)
+
+
 def ensure_column(table: str, column: str, col_type: str = "TEXT"):
-    """Добавляет колонку в таблицу, если её нет"""
-    if DB_URL:
-        # PostgreSQL
-        try:
-            execute_query(f'ALTER TABLE {table} ADD COLUMN "{column}" {col_type}', fetch=False)
-        except:
-            pass  # Колонка уже существует
-    else:
-        # SQLite
-        conn = get_conn()
+    """Добавляет колонку в таблицу, если её нет (список колонок — из кэша table_columns)"""
+    if column not in table_columns(table):
+        add_columns(table, [(column, col_type)])
+
+
+def add_columns(table: str, columns: list):
+    """Добавляет колонки [(имя, тип)] одним ALTER (PostgreSQL) или одной транзакцией (SQLite)"""
+    if not columns:
+        return
+    
+    conn = get_conn()
+    try:
         cur = conn.cursor()
-        cur.execute(f"PRAGMA table_info({table})")
-        existing = {r[1] for r in cur.fetchall()}
-        if column not in existing:
-            cur.execute(f'ALTER TABLE {table} ADD COLUMN "{column}" {col_type}')
-            conn.commit()
+        if DB_URL:
+            cur.execute(f"ALTER TABLE {table} " + ", ".join(
+                f'ADD COLUMN IF NOT EXISTS "{c}" {t}' for c, t in columns
+            ))
+        else:
+            cur.execute("BEGIN")
+            for c, t in columns:
+                cur.execute(f'ALTER TABLE {table} ADD COLUMN "{c}" {t}')
+        conn.commit()
+        cur.close()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
         conn.close()
+    table_columns.clear()
 
 
+@st.cache_data(ttl=60)
 def table_columns(table: str):
     """Возвращает список колонок таблицы"""
     if DB_URL:
@@ -150,8 +252,9 @@ def table_columns(table: str):
         return cols
 
 
+@st.cache_resource
 def init_db():
-    """Инициализация базы данных"""
+    """Инициализация базы данных (один раз на процесс, а не на каждый rerun)"""
     
     if DB_URL:
         # PostgreSQL синтаксис
@@ -249,29 +352,38 @@ def init_db():
             )
         """, fetch=False)
     
-    # Инициализация registry
+    # Инициализация registry: один батч, существующие поля пропускаются
     now = datetime.now().isoformat(timespec="seconds")
-    for f in TZ_FIELDS_31:
-        try:
-            execute_query(
-                "INSERT INTO fields_registry(field, field_type, created_at) VALUES (%s,%s,%s)",
-                (f, "REAL" if f in DEFAULT_NUMERIC_FIELDS else "TEXT", now),
-                fetch=False
-            )
-        except:
-            pass  # Поле уже существует
+    if DB_URL:
+        seed_query = ("INSERT INTO fields_registry(field, field_type, created_at) VALUES (%s,%s,%s) "
+                      "ON CONFLICT (field) DO NOTHING")
+    else:
+        seed_query = "INSERT OR IGNORE INTO fields_registry(field, field_type, created_at) VALUES (%s,%s,%s)"
+    execute_many(seed_query, [
+        (f, "REAL" if f in DEFAULT_NUMERIC_FIELDS else "TEXT", now) for f in TZ_FIELDS_31
+    ])
     
-    # Добавляем колонки в data
+    # Добавляем недостающие колонки в data
     registry_df = execute_query("SELECT field, field_type FROM fields_registry")
-    for _, row in registry_df.iterrows():
-        ensure_column("data", row["field"], row["field_type"])
+    cols_in_table = set(table_columns("data"))
+    add_columns("data", [(f, t) for f, t in zip(registry_df["field"], registry_df["field_type"])
+                         if f not in cols_in_table])
+    
+    # Индексы под удаление загрузки и выборку данных пользователя
+    execute_query("CREATE INDEX IF NOT EXISTS idx_data_upload_id ON data(upload_id)", fetch=False)
+    execute_query("CREATE INDEX IF NOT EXISTS idx_data_uploaded_by ON data(uploaded_by)", fetch=False)
+    
+    # Составной индекс под частые фильтры дашборда
+    if set(DEFAULT_FILTER_FIELDS) <= set(table_columns("data")):
+        cols_sql = ", ".join(f'"{c}"' for c in DEFAULT_FILTER_FIELDS)
+        execute_query(f"CREATE INDEX IF NOT EXISTS idx_data_filters ON data({cols_sql})", fetch=False)
     
     # Seed admin
     users_count = execute_query("SELECT COUNT(*) as cnt FROM users")
     if users_count.iloc[0]["cnt"] == 0:
         execute_query(
             "INSERT INTO users(email, role, password_hash, created_at) VALUES (%s,%s,%s,%s)",
-            ("admin@local", "admin", sha256("admin"), now),
+            ("admin@local", "admin", hash_password("admin"), now),
             fetch=False
         )
 
@@ -287,6 +399,76 @@ def init_session():
                 st.session_state.user = {"email": df.iloc[0]["email"], "role": df.iloc[0]["role"]}
 
 
+def _clear_edit_state():
+    """Сбрасывает состояние панели редактирования записи (без KeyError на отсутствующих ключах)"""
+    st.session_state.pop(f"edit_grid_{st.session_state.get('edit_row_id')}", None)
+    for k in ("edit_row_id", "edit_frame", "edit_column_config"):
+        st.session_state.pop(k, None)
+
+
+# Значения, которые в редакторе показываются пустой строкой
+_EMPTY_VALUES = frozenset({None, "None", ""})
+
+
+def _edit_frame(fields: list, edit_data: dict) -> pd.DataFrame:
+    """Одна строка для st.data_editor: числа — float (пусто = 0.0), текст — str (пусто = "")"""
+    row = {}
+    for f in fields:
+        v = edit_data.get(f)
+        if f in DEFAULT_NUMERIC_FIELDS:
+            row[f] = float(v) if v else 0.0
+        else:
+            row[f] = "" if v in _EMPTY_VALUES else str(v)
+    return pd.DataFrame([row], columns=fields)
+
+
+def _edit_column_config(fields: list) -> dict:
+    return {f: st.column_config.NumberColumn(f, format="%.2f") if f in DEFAULT_NUMERIC_FIELDS
+            else st.column_config.TextColumn(f)
+            for f in fields}
+
+
+@st.fragment
+def render_edit_panel():
+    """Панель редактирования записи; её кнопки перезапускают только этот фрагмент"""
+    if "edit_frame" in st.session_state:
+        st.markdown(f"**Редактирование записи ID = {st.session_state.edit_row_id}**")
+        
+        # Форма: правка полей не вызывает rerun до нажатия кнопки
+        with st.form("edit_row_form", clear_on_submit=False):
+            # Один редактор-таблица вместо отдельного виджета на каждое поле
+            edited = st.data_editor(
+                st.session_state.edit_frame,
+                column_config=st.session_state.edit_column_config,
+                num_rows="fixed",
+                hide_index=True,
+                use_container_width=True,
+                key=f"edit_grid_{st.session_state.edit_row_id}"
+            )
+            
+            col_save, col_cancel = st.columns(2)
+            with col_save:
+                save_clicked = st.form_submit_button("✅ Сохранить изменения", use_container_width=True, type="primary")
+            with col_cancel:
+                # Состояние сбрасывается в колбэке до перерисовки фрагмента — отдельный rerun не нужен
+                st.form_submit_button("❌ Отмена", use_container_width=True, on_click=_clear_edit_state)
+        
+        if save_clicked:
+            # Изменённые поля: одно сравнение фреймов по колонкам (с учётом типов) вместо цикла
+            changed = edited.ne(st.session_state.edit_frame).iloc[0]
+            updated_values = edited.loc[:, changed].iloc[0].to_dict()
+            if updated_values:
+                update_data_row(st.session_state.edit_row_id, updated_values)
+                st.success(f"Запись #{st.session_state.edit_row_id} обновлена! Изменено полей: {len(updated_values)}")
+                _clear_edit_state()
+                # Список записей вне фрагмента — после сохранения обновляем всю страницу
+                st.rerun(scope="app")
+            else:
+                st.warning("Нет изменений для сохранения.")
+    else:
+        st.info("👈 Выберите ID записи слева и нажмите 'Загрузить для редактирования'")
+
+
 # ====== Auth ======
 def login_box():
     st.sidebar.header("🔐 Вход")
@@ -297,18 +479,27 @@ def login_box():
     if st.session_state.user:
         return True
     
-    email = st.sidebar.text_input("Email", placeholder="user@company.com")
-    password = st.sidebar.text_input("Пароль", type="password")
+    # Форма: ввод email/пароля не вызывает rerun, проверка только по кнопке
+    with st.sidebar.form("login_form"):
+        email = st.text_input("Email", placeholder="user@company.com")
+        password = st.text_input("Пароль", type="password")
+        submitted = st.form_submit_button("Войти", use_container_width=True)
     
-    if st.sidebar.button("Войти", use_container_width=True):
+    if submitted:
         df_user = execute_query(
-            "SELECT email, role FROM users WHERE email=%s AND password_hash=%s",
-            (email.strip().lower(), sha256(password))
+            "SELECT email, role, password_hash FROM users WHERE email=%s",
+            (email.strip().lower(),)
         )
         
-        if df_user.empty:
+        if df_user.empty or not verify_password(df_user.iloc[0]["password_hash"], password):
             st.sidebar.error("Неверный email или пароль.")
         else:
+            if password_needs_rehash(df_user.iloc[0]["password_hash"]):
+                execute_query(
+                    "UPDATE users SET password_hash=%s WHERE email=%s",
+                    (hash_password(password), df_user.iloc[0]["email"]),
+                    fetch=False
+                )
             st.session_state.user = {"email": df_user.iloc[0]["email"], "role": df_user.iloc[0]["role"]}
             st.query_params["auth_email"] = df_user.iloc[0]["email"]
             st.rerun()
@@ -326,6 +517,7 @@ def logout_box():
 
 
 # ====== Business logic ======
+@st.cache_data(ttl=60)
 def load_mapping_rules() -> pd.DataFrame:
     try:
         return execute_query("SELECT * FROM mapping_rules ORDER BY id DESC")
@@ -333,102 +525,136 @@ def load_mapping_rules() -> pd.DataFrame:
         return pd.DataFrame(columns=["id", "field", "source_text", "target_text", "match_type"])
 
 
+@st.cache_data(ttl=60)
+def _fields_registry() -> list:
+    """Список полей из fields_registry (в порядке добавления; поля одного батча — по имени)"""
+    return execute_query("SELECT field FROM fields_registry ORDER BY created_at, field")["field"].tolist()
+
+
 def apply_mapping_rules(df: pd.DataFrame, rules: pd.DataFrame) -> pd.DataFrame:
-    if rules.empty:
+    """
+    Применяет правила сопоставления (изменяет df на месте). Правила применяются
+    по порядку: каждое видит значения, уже переписанные предыдущими.
+    """
+    # Только правила для колонок, которые есть в df; нет таких — нечего делать
+    applicable = rules[rules["field"].isin(df.columns)]
+    if applicable.empty:
         return df
     
-    df2 = df.copy()
-    for _, r in rules.iterrows():
-        field = r["field"]
-        if field not in df2.columns:
-            continue
-        
-        src = str(r["source_text"])
-        tgt = str(r["target_text"])
-        mt = r.get("match_type", "contains")
+    for field, grp in applicable.groupby("field", sort=False):
+        # Колонка приводится к строке один раз на поле; правила проверяются
+        # только на различных значениях (в сетях/регионах их единицы на тысячи строк)
+        codes, uniques = pd.factorize(df[field].astype(str))
+        values = pd.Series(uniques, dtype=object)
+        # Ключ для equals (strip + lower) считается один раз и обновляется при замене
+        folded = values.str.strip().str.lower()
+        touched = np.zeros(len(values), dtype=bool)
         
-        col = df2[field].astype(str)
+        for src, tgt, mt in zip(grp["source_text"], grp["target_text"], grp["match_type"]):
+            src, tgt = str(src), str(tgt)
+            if mt == "equals":
+                mask = folded.eq(src.strip().lower()).to_numpy()
+            else:  # contains
+                mask = values.str.contains(src, case=False, na=False).to_numpy()
+            if mask.any():
+                values[mask] = tgt
+                folded[mask] = tgt.strip().lower()
+                touched |= mask
         
-        if mt == "equals":
-            mask = col.str.strip().str.lower().eq(src.strip().lower())
-        else:  # contains
-            mask = col.str.contains(src, case=False, na=False)
-        
-        df2.loc[mask, field] = tgt
+        # Переписываются только строки, значение которых задело хоть одно правило;
+        # пустые значения (код -1) указывают на добавленный False
+        rows = np.append(touched, False)[codes]
+        if rows.any():
+            df.loc[rows, field] = values.to_numpy()[codes[rows]]
     
-    return df2
+    return df
+
+
+# Целочисленные поля и Arrow-типы для coerce_types (создаются один раз)
+INTEGER_FIELDS = frozenset({"Код_клиента", "Артикул_Элта", "Год", "Месяц"})
+_INT64 = pd.ArrowDtype(pa.int64())
+_FLOAT64 = pd.ArrowDtype(pa.float64())
 
 
 def coerce_types(df: pd.DataFrame) -> pd.DataFrame:
-    df2 = df.copy()
-    
-    for col in ["Код_клиента", "Артикул_Элта", "Год", "Месяц"]:
-        if col in df2.columns:
-            df2[col] = pd.to_numeric(df2[col], errors="coerce").astype("Int64")
+    """Приводит типы колонок за один проход по колонкам df (изменяет df на месте)"""
+    for col in df.columns:
+        if col in INTEGER_FIELDS:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype(_INT64)
+        elif col in DEFAULT_NUMERIC_FIELDS:
+            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0).astype(_FLOAT64)
+        elif col in CATEGORY_FIELDS:
+            df[col] = df[col].astype("category")
     
-    for col in DEFAULT_NUMERIC_FIELDS:
-        if col in df2.columns:
-            df2[col] = pd.to_numeric(df2[col], errors="coerce").fillna(0)
+    return df
+
+
+def totals_row(df: pd.DataFrame, totals: dict = None, columns: list = None):
+    """
+    Строка ИТОГО отдельным DataFrame из одной строки (df не копируется и не дополняется).
+    totals — готовые суммы (например, из load_totals), иначе считаются по df.
+    None, если числовых колонок нет.
+    """
+    columns = list(df.columns) if columns is None else columns
+    numeric_cols = [c for c in DEFAULT_NUMERIC_FIELDS if c in columns]
+    if not numeric_cols:
+        return None
     
-    return df2
+    if totals is None:
+        totals = df[numeric_cols].sum(numeric_only=True)
+    total_row = {c: "" for c in columns}
+    for c in numeric_cols:
+        total_row[c] = float(totals.get(c, 0))
+    total_row["Итого"] = "ИТОГО"
+    return pd.DataFrame([total_row], index=["ИТОГО"], columns=columns)
 
 
-def compute_totals_row(df: pd.DataFrame) -> pd.DataFrame:
-    df2 = df.copy()
-    numeric_cols = [c for c in DEFAULT_NUMERIC_FIELDS if c in df2.columns]
-    if numeric_cols:
-        totals = df2[numeric_cols].sum(numeric_only=True)
-        total_row = {c: "" for c in df2.columns}
-        for c in numeric_cols:
-            total_row[c] = float(totals.get(c, 0))
-        total_row["Итого"] = "ИТОГО"
-        df2.loc["ИТОГО"] = total_row
-    return df2
+@st.cache_data(max_entries=4, show_spinner=False)
+def _read_first_sheet(content: bytes) -> pd.DataFrame:
+    """Первый лист xlsx; ключ кэша — содержимое файла, поэтому rerun не перечитывает тот же файл"""
+    # calamine (Rust) читает xlsx в разы быстрее openpyxl
+    return pd.read_excel(io.BytesIO(content), sheet_name=0, engine="calamine")
 
 
 def parse_file(uploaded_file) -> pd.DataFrame:
-    df = pd.read_excel(uploaded_file, sheet_name=0)
-    
-    has_year = any(str(c).strip().lower() in ["год", "year"] for c in df.columns)
+    """Разбор загруженного файла; повторный rerun с тем же файлом и теми же правилами берёт результат из кэша"""
+    rules_version = tuple(load_mapping_rules()["id"].tolist())
+    return _parse_content(uploaded_file.getvalue(), tuple(_fields_registry()), rules_version)
+
+
+@functools.lru_cache(maxsize=32)
+def _normalized_headers(headers: tuple) -> tuple:
+    """Имена полей для заголовков файла; одна и та же раскладка колонок разбирается один раз"""
+    has_year = any(c.strip().lower() in YEAR_HEADERS for c in map(str, headers))
     if not has_year:
-        cols = IMPORT_COLUMNS_23[:len(df.columns)]
-        df.columns = cols
-    
-    df = df.rename(columns={
-        "Код клиента": "Код_клиента",
-        "Наименование товара клиента": "Наименование_товара_клиента",
-        "Поставщик общий": "Поставщик_общий",
-        "Юридическое лицо": "Юр_лицо",
-        "Адрес аптеки": "Адрес_аптеки",
-        "Федеральный округ": "Федеральный_округ",
-        "Артикул Элта": "Артикул_Элта",
-        "Полное наименование Элта": "Полное_наименование_Элта",
-        "Региональный менеджер": "Региональный_менеджер",
-        "Медицинский представитель": "Медицинский_представитель",
-        "Закупки Кол-во упаковок": "Закупки_колво",
-        "Закупки кол-во упаковок": "Закупки_колво",
-        "Закупки сумма в закупочных ценах": "Закупки_сумма",
-        "Продажи кол-во упаковок": "Продажи_колво",
-        "Продажи сумма в закупочных ценах": "Продажи_сумма",
-        "Продажи сумма в закупочных ценах/ценах реализации": "Продажи_сумма",
-        "Остатки кол-во упаковок": "Остатки_колво",
-        "Тест-полоски 50": "Тест_полоски_50",
-        "Тест-полоски 25": "Тест_полоски_25",
-    })
+        headers = IMPORT_COLUMNS_23[:len(headers)]
+    return tuple(COLUMN_RENAMES.get(c, c) for c in headers)
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _parse_content(content: bytes, registry: tuple, rules_version: tuple) -> pd.DataFrame:
+    """registry и rules_version (id правил) входят в ключ: правка полей или правил даёт новый разбор"""
+    df = _read_first_sheet(content)
     
-    registry = execute_query("SELECT field FROM fields_registry")["field"].tolist()
-    for f in registry:
-        if f not in df.columns:
-            df[f] = None
+    # Заголовки нормализуются одним присваиванием df.columns вместо rename (без копии данных)
+    df.columns = _normalized_headers(tuple(df.columns))
     
     rules = load_mapping_rules()
-    df = apply_mapping_rules(df, rules)
-    df = coerce_types(df)
+    registry = list(registry)
     
-    ordered = [c for c in registry if c in df.columns]
-    df = df[ordered]
+    if df.columns.is_unique:
+        # Обычный случай: правила по имеющимся колонкам, затем недостающие
+        # поля и порядок registry — одним reindex вместо цикла по полям
+        df = apply_mapping_rules(df, rules).reindex(columns=registry)
+    else:
+        # После rename два заголовка могли стать одним полем — reindex так не умеет
+        for f in registry:
+            if f not in df.columns:
+                df[f] = None
+        df = apply_mapping_rules(df, rules)
+        df = df[[c for c in registry if c in df.columns]]
     
-    return df
+    return coerce_types(df)
 
 
 def save_upload(filename: str, uploaded_by: str) -> int:
@@ -451,34 +677,168 @@ def save_data(df: pd.DataFrame, upload_id: int, uploaded_by: str):
     
     # Убедимся, что все колонки существуют в таблице
     cols_in_table = set(table_columns("data"))
-    for col in df.columns:
-        if col not in cols_in_table:
-            ensure_column("data", col, "REAL" if col in DEFAULT_NUMERIC_FIELDS else "TEXT")
-            cols_in_table.add(col)
+    add_columns("data", [(col, "REAL" if col in DEFAULT_NUMERIC_FIELDS else "TEXT")
+                         for col in df.columns if col not in cols_in_table])
     
     now = datetime.now().isoformat(timespec="seconds")
-    to_save = df.copy()
-    to_save["upload_id"] = upload_id
-    to_save["uploaded_by"] = uploaded_by
-    to_save["uploaded_at"] = now
+    to_save = df.assign(upload_id=upload_id, uploaded_by=uploaded_by, uploaded_at=now)
     
-    # Для PostgreSQL используем SQLAlchemy engine
     if DB_URL:
-        from sqlalchemy import create_engine
-        engine = create_engine(DB_URL)
-        to_save.to_sql("data", engine, if_exists="append", index=False)
-        engine.dispose()
+        # PostgreSQL: один COPY FROM STDIN вместо INSERT на каждую строку
+        buf = io.StringIO()
+        to_save.to_csv(buf, index=False, header=False, na_rep="\\N")
+        buf.seek(0)
+        cols_sql = ", ".join(f'"{c}"' for c in to_save.columns)
+        conn = get_conn()
+        try:
+            cur = conn.cursor()
+            cur.copy_expert(f"COPY data ({cols_sql}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buf)
+            conn.commit()
+            cur.close()
+        finally:
+            conn.close()
     else:
-        # Для SQLite используем прямое подключение
+        # SQLite: многострочные INSERT пачками в одной транзакции
+        cols_sql = ", ".join(f'"{c}"' for c in to_save.columns)
+        row_sql = "(" + ",".join("?" * len(to_save.columns)) + ")"
+        # object + None вместо NaN/NA, чтобы sqlite3 получал обычные питоновские значения
+        rows = list(to_save.astype(object).where(to_save.notna(), None).itertuples(index=False, name=None))
         conn = get_conn()
-        to_save.to_sql("data", conn, if_exists="append", index=False)
-        conn.close()
+        try:
+            # Размер пачки — по фактическому лимиту параметров сборки (3.32+: от 32766)
+            getlimit = getattr(conn.driver_connection, "getlimit", None)
+            max_vars = getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER) if getlimit else SQLITE_MAX_VARIABLES
+            chunk_rows = max(1, min(SQLITE_INSERT_CHUNK_ROWS, max_vars // len(to_save.columns)))
+            cur = conn.cursor()
+            cur.execute("BEGIN")
+            for start in range(0, len(rows), chunk_rows):
+                chunk = rows[start:start + chunk_rows]
+                cur.execute(
+                    f"INSERT INTO data ({cols_sql}) VALUES " + ",".join([row_sql] * len(chunk)),
+                    [v for row in chunk for v in row]
+                )
+            conn.commit()
+            cur.close()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+    
+    clear_data_caches()
+
+
+def _data_where(filters: dict = None, user_email: str = None, role: str = "admin"):
+    """WHERE для таблицы data: видимость по роли + фильтры дашборда {поле: [значения]}"""
+    clauses, params = [], []
+    if role == "user" and user_email:
+        clauses.append("uploaded_by=%s")
+        params.append(user_email)
+    for field, values in (filters or {}).items():
+        if not values:
+            continue
+        clauses.append(f'"{field}" IN ({",".join(["%s"] * len(values))})')
+        params.extend(values)
+    where = " WHERE " + " AND ".join(clauses) if clauses else ""
+    return where, tuple(params)
+
+
+def _dashboard_categories(df: pd.DataFrame) -> pd.DataFrame:
+    """Колонки фильтров — category: коды вместо строк, unique/isin/groupby по кодам (изменяет df на месте)"""
+    for col in DASHBOARD_CATEGORY_FIELDS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    return df
 
+
+@st.cache_data(ttl=300, show_spinner=False)
 def load_data(user_email: str = None, role: str = "admin") -> pd.DataFrame:
     if role == "user" and user_email:
-        return execute_query("SELECT * FROM data WHERE uploaded_by=%s", (user_email,))
+        df = execute_query("SELECT * FROM data WHERE uploaded_by=%s", (user_email,))
     else:
-        return execute_query("SELECT * FROM data")
+        df = execute_query("SELECT * FROM data")
+    return _dashboard_categories(df)
+
+
+@st.cache_data(ttl=60, max_entries=8)
+def load_data_filtered(filters: dict, user_email: str = None, role: str = "admin") -> pd.DataFrame:
+    """Строки data с фильтрами дашборда, применёнными на стороне БД"""
+    where, params = _data_where(filters, user_email, role)
+    return _dashboard_categories(execute_query(f"SELECT * FROM data{where}", params))
+
+
+@st.cache_data(ttl=60, max_entries=64)
+def load_aggregate(field: str, value_field: str, filters: dict = None, user_email: str = None,
+                   role: str = "admin", positive_only: bool = False) -> pd.DataFrame:
+    """SUM(value_field) по значениям field, посчитанная в БД (для графиков)"""
+    where, params = _data_where(filters, user_email, role)
+    conds = [f'"{field}" IS NOT NULL']
+    if positive_only:
+        conds.append(f'"{value_field}" > 0')
+    where = (where + " AND " if where else " WHERE ") + " AND ".join(conds)
+    return execute_query(
+        f'SELECT "{field}", SUM("{value_field}") AS "{value_field}" FROM data{where} GROUP BY "{field}"',
+        params
+    )
+
+
+@st.cache_data(ttl=60, max_entries=64)
+def load_totals(columns: tuple, filters: dict = None, user_email: str = None, role: str = "admin") -> dict:
+    """SUM по числовым колонкам, посчитанные в БД (строка ИТОГО дашборда)"""
+    where, params = _data_where(filters, user_email, role)
+    sums_sql = ", ".join(f'SUM("{c}") AS "{c}"' for c in columns)
+    row = execute_query(f"SELECT {sums_sql} FROM data{where}", params).iloc[0]
+    return {c: 0.0 if pd.isna(row[c]) else float(row[c]) for c in columns}
+
+
+@st.cache_data(ttl=60)
+def _column_options(_df: pd.DataFrame, fingerprint: tuple, col: str) -> list:
+    """Варианты для фильтра по колонке. _df не хэшируется — ключ кэша задаёт fingerprint"""
+    if isinstance(_df[col].dtype, pd.CategoricalDtype):
+        # Категории уже уникальны и без пропусков — O(k) вместо прохода по всем строкам
+        return sorted(_df[col].cat.categories.tolist())
+    return sorted(pd.unique(_df[col].dropna()).tolist())
+
+
+RECENT_DATA_COLUMNS = ["id", "Год", "Месяц", "Сеть", "Наименование_товара_клиента", "uploaded_by"]
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _editor_bootstrap() -> tuple:
+    """Список полей registry для админки и MAX(id) data (версия для кэша превью) одним запросом.
+    Сбрасывается вместе с кэшами data и при изменении registry"""
+    df = execute_query(
+        "SELECT f.field, f.field_type, f.created_at, v.m AS data_max_id "
+        "FROM (SELECT MAX(id) AS m FROM data) v LEFT JOIN fields_registry f ON 1=1 "
+        "ORDER BY f.created_at DESC"
+    )
+    m = df.iloc[0]["data_max_id"]
+    fields_df = df.dropna(subset=["field"]).drop(columns="data_max_id").reset_index(drop=True)
+    return fields_df, 0 if pd.isna(m) else int(m)
+
+
+@st.cache_data(ttl=300)
+def load_recent_data(max_id: int, limit: int = 100) -> pd.DataFrame:
+    """Последние записи data для списка в админке (компактные типы для передачи в браузер).
+    max_id входит в ключ кэша: новые записи из других процессов сбрасывают его сами"""
+    cols_sql = ", ".join(f'"{c}"' for c in RECENT_DATA_COLUMNS)
+    df = execute_query(f"SELECT {cols_sql} FROM data ORDER BY id DESC LIMIT {int(limit)}")
+    df["id"] = df["id"].astype(pd.ArrowDtype(pa.int32()))
+    for col in RECENT_DATA_COLUMNS[1:]:
+        df[col] = df[col].astype("category")
+    return df
+
+
+def clear_data_caches():
+    """Сбрасывает кэши, зависящие от содержимого таблицы data"""
+    load_data.clear()
+    load_recent_data.clear()
+    load_data_filtered.clear()
+    load_aggregate.clear()
+    load_totals.clear()
+    _column_options.clear()
+    get_data_row.clear()
+    _editor_bootstrap.clear()
 
 
 def delete_upload(upload_id: int, user_email: str, role: str) -> bool:
@@ -489,18 +849,41 @@ def delete_upload(upload_id: int, user_email: str, role: str) -> bool:
     
     execute_query("DELETE FROM data WHERE upload_id=%s", (upload_id,), fetch=False)
     execute_query("DELETE FROM uploads WHERE id=%s", (upload_id,), fetch=False)
+    clear_data_caches()
     return True
 
 
-def get_data_row(row_id: int) -> pd.DataFrame:
-    return execute_query("SELECT * FROM data WHERE id=%s", (row_id,))
+@st.cache_data(ttl=30, show_spinner=False)
+def get_data_row(row_id: int, columns: list) -> pd.DataFrame:
+    """Одна запись data: id и только запрошенные поля registry"""
+    allowed = set(_fields_registry()) & set(table_columns("data"))
+    unknown = [c for c in columns if c not in allowed]
+    if unknown:
+        raise ValueError(f"Неизвестные поля: {unknown}")
+    cols_sql = ", ".join(["id"] + [f'"{c}"' for c in columns])
+    return execute_query(f"SELECT {cols_sql} FROM data WHERE id=%s", (row_id,))
+
+
+@functools.lru_cache(maxsize=128)
+def _update_row_sql(columns: tuple) -> str:
+    """UPDATE по набору колонок; один и тот же набор полей не собирается заново"""
+    set_clause = ", ".join(f'"{c}"=%s' for c in columns)
+    return f"UPDATE data SET {set_clause} WHERE id=%s"
 
 
 def update_data_row(row_id: int, updates: dict):
-    set_clause = ", ".join([f'"{k}"=%s' for k in updates.keys()])
-    values = list(updates.values()) + [row_id]
-    sql = f"UPDATE data SET {set_clause} WHERE id=%s"
-    execute_query(sql, tuple(values), fetch=False)
+    """Обновляет поля записи одним UPDATE (один round-trip и один commit)"""
+    if not updates:
+        return
+    # Те же поля, что разрешены при загрузке записи: registry ∩ колонки data, без служебных
+    allowed = (set(_fields_registry()) & set(table_columns("data"))) - SYSTEM_FIELDS
+    unknown = [k for k in updates if k not in allowed]
+    if unknown:
+        raise ValueError(f"Неизвестные поля: {unknown}")
+    # Пропуски (NaN/NA от очищенной ячейки редактора) — NULL: psycopg2 иначе пишет 'NaN'::float
+    values = [None if pd.isna(v) else v for v in updates.values()] + [row_id]
+    execute_query(_update_row_sql(tuple(updates)), tuple(values), fetch=False)
+    clear_data_caches()
 
 
 def update_field_registry(old_field: str, new_field: str, new_type: str):
@@ -509,10 +892,14 @@ def update_field_registry(old_field: str, new_field: str, new_type: str):
         (new_field, new_type, old_field),
         fetch=False
     )
+    _fields_registry.clear()
+    _editor_bootstrap.clear()
     
     if old_field != new_field:
         if DB_URL:
             execute_query(f'ALTER TABLE data RENAME COLUMN "{old_field}" TO "{new_field}"', fetch=False)
+            table_columns.clear()
+            clear_data_caches()
         else:
             # SQLite - нужна миграция, пока просто обновляем registry
             pass
@@ -520,21 +907,35 @@ def update_field_registry(old_field: str, new_field: str, new_type: str):
 
 def delete_field_registry(field: str):
     execute_query("DELETE FROM fields_registry WHERE field=%s", (field,), fetch=False)
+    _fields_registry.clear()
+    _editor_bootstrap.clear()
 
 
-def filter_df(df: pd.DataFrame, filters: dict) -> pd.DataFrame:
-    out = df.copy()
-    for field, values in filters.items():
-        if not values or field not in out.columns:
-            continue
-        out = out[out[field].isin(values)]
-    return out
-
-
-def export_xlsx(df: pd.DataFrame) -> bytes:
+def export_xlsx(df: pd.DataFrame, total_df: pd.DataFrame = None) -> bytes:
+    """
+    Выгрузка в xlsx построчно. xlsxwriter в режиме constant_memory сбрасывает
+    каждую строку на диск сразу, поэтому to_excel (пишет по столбцам) не подходит.
+    total_df (строка ИТОГО) дописывается в конец без склейки с df.
+    """
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="Отчет")
+    workbook = xlsxwriter.Workbook(output, {
+        "constant_memory": True,
+        "nan_inf_to_errors": True,
+        "remove_timezone": True,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss",
+    })
+    ws = workbook.add_worksheet("Отчет")
+    ws.write_row(0, 0, [str(c) for c in df.columns])
+    
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    for i, row in enumerate(rows, start=1):
+        ws.write_row(i, 0, row)
+    
+    if total_df is not None:
+        for i, row in enumerate(total_df.itertuples(index=False, name=None), start=len(df) + 1):
+            ws.write_row(i, 0, row)
+    
+    workbook.close()
     return output.getvalue()
 
 
@@ -565,9 +966,10 @@ with tab_objs[0]:
         st.caption(f"Колонки: {len(df_parsed.columns)}; строк: {len(df_parsed)}")
         st.dataframe(df_parsed.head(50), use_container_width=True)
         
-        df_with_totals = compute_totals_row(df_parsed)
+        total_df = totals_row(df_parsed)
         st.markdown("**ИТОГО (предпросмотр):**")
-        st.dataframe(df_with_totals.tail(5), use_container_width=True)
+        st.dataframe(df_parsed.tail(4) if total_df is None else pd.concat([df_parsed.tail(4), total_df]),
+                     use_container_width=True)
         
         if st.button("✅ Сохранить в базу", use_container_width=True):
             upload_id = save_upload(uploaded.name, user["email"])
@@ -584,7 +986,7 @@ with tab_objs[1]:
     else:
  # Динамический выбор фильтров
         st.subheader("Фильтры")
-        all_columns = [col for col in df.columns if col not in {"id", "upload_id", "uploaded_by", "uploaded_at"}]
+        all_columns = [col for col in df.columns if col not in SYSTEM_FIELDS]
         available_filters = st.multiselect(
             "Выберите поля для фильтрации:",
             options=sorted(all_columns),
@@ -593,37 +995,45 @@ with tab_objs[1]:
         )
 
         filters = {}
+        # Дешёвый отпечаток набора данных вместо хэширования всего df
+        df_fingerprint = (user["email"], user["role"], len(df), int(df["id"].max()))
         if available_filters:
             filter_cols = st.columns(min(5, len(available_filters)))
             for i, field in enumerate(available_filters):
                 with filter_cols[i % 5]:
                     if field in df.columns and len(df[field].dropna()) > 0:
-                        options = sorted(df[field].dropna().unique().tolist())
+                        options = _column_options(df, df_fingerprint, field)
                         filters[field] = st.multiselect(
                             field, 
                             options=options,
                             key=f"filter_{field}"
                         )
         
-        filtered = filter_df(df, filters)
+        if any(filters.values()):
+            filtered = load_data_filtered(filters, user["email"], user["role"])
+        else:
+            filtered = df
         
         system_cols = {"id", "upload_id", "uploaded_at"}
         if user["role"] != "admin":
             system_cols.add("uploaded_by")
         show_cols = [c for c in filtered.columns if c not in system_cols]
         
-        filtered_show = filtered[show_cols].copy()
-        filtered_show = compute_totals_row(filtered_show)
+        totals_cols = tuple(sorted(c for c in DEFAULT_NUMERIC_FIELDS if c in show_cols))
+        totals = load_totals(totals_cols, filters, user["email"], user["role"]) if totals_cols else None
+        total_df = totals_row(filtered, totals, show_cols)
         
         st.caption(f"Строк: {len(filtered)} (без ИТОГО). Роль: {user['role']}")
-        st.dataframe(filtered_show, use_container_width=True)
+        st.dataframe(filtered[show_cols], use_container_width=True)
+        if total_df is not None:
+            st.dataframe(total_df, use_container_width=True)
         
         # НОВАЯ КНОПКА XLSX ПОСЛЕ ФИЛЬТРОВ
         if not filtered.empty:
-            xlsx_bytes_quick = export_xlsx(filtered)
+            # xlsx собирается только по нажатию кнопки, а не на каждом rerun
             st.download_button(
                 "📥 Скачать XLSX",
-                data=xlsx_bytes_quick,
+                data=functools.partial(export_xlsx, filtered),
                 file_name=f"elta_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                 use_container_width=True
@@ -656,23 +1066,22 @@ with tab_objs[1]:
         colA, colB = st.columns(2)
         with colA:
             if "Сеть" in filtered.columns and "Продажи_сумма" in filtered.columns:
-                df_chart = filtered.dropna(subset=["Сеть"])
+                df_chart = load_aggregate("Сеть", "Продажи_сумма", filters, user["email"], user["role"])
                 fig = px.pie(df_chart, names="Сеть", values="Продажи_сумма", title="Продажи (сумма) по сетям")
                 st.plotly_chart(fig, use_container_width=True)
         with colB:
             if "Регион" in filtered.columns and "Закупки_колво" in filtered.columns:
-                df_chart = filtered[filtered["Регион"].notna() & (filtered["Закупки_колво"] > 0)]
-                if len(df_chart) > 0:
-                    df_grouped = df_chart.groupby("Регион")["Закупки_колво"].sum().reset_index()
+                df_grouped = load_aggregate("Регион", "Закупки_колво", filters, user["email"], user["role"],
+                                            positive_only=True)
+                if len(df_grouped) > 0:
                     fig = px.pie(df_grouped, names="Регион", values="Закупки_колво", title="Закупки (кол-во) по регионам")
                     st.plotly_chart(fig, use_container_width=True)
                 else:
                     st.info("Нет данных по закупкам с заполненным Регионом")
         
-        xlsx_bytes = export_xlsx(filtered_show)
         st.download_button(
             "📥 Скачать XLSX",
-            data=xlsx_bytes,
+            data=functools.partial(export_xlsx, filtered[show_cols], total_df),
             file_name="elta_export.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             use_container_width=True
@@ -698,14 +1107,14 @@ if user["role"] == "admin":
                     try:
                         execute_query(
                             "INSERT INTO users(email, role, password_hash, created_at) VALUES (%s,%s,%s,%s)",
-                            (new_email, new_role, sha256(new_pass), now),
+                            (new_email, new_role, hash_password(new_pass), now),
                             fetch=False
                         )
                     except:
                         # Если пользователь существует, обновляем
                         execute_query(
                             "UPDATE users SET role=%s, password_hash=%s WHERE email=%s",
-                            (new_role, sha256(new_pass), new_email),
+                            (new_role, hash_password(new_pass), new_email),
                             fetch=False
                         )
                     st.success(f"Пользователь '{new_email}' ({new_role}) создан/обновлён.")
@@ -722,7 +1131,7 @@ if user["role"] == "admin":
         c3, c4 = st.columns(2)
         with c3:
             st.markdown("**Добавить правило**")
-            registry_fields = execute_query("SELECT field FROM fields_registry ORDER BY field")["field"].tolist()
+            registry_fields = sorted(_fields_registry())
             rule_field = st.selectbox("Поле", registry_fields, index=registry_fields.index("Наименование_товара_клиента") if "Наименование_товара_клиента" in registry_fields else 0, key="rule_field")
             src = st.text_input("Искать (source_text)", key="rule_src")
             tgt = st.text_input("Заменять на (target_text)", key="rule_tgt")
@@ -737,6 +1146,7 @@ if user["role"] == "admin":
                         (rule_field, src, tgt, mtype, now),
                         fetch=False
                     )
+                    load_mapping_rules.clear()
                     st.success("Правило добавлено.")
                     st.rerun()
         
@@ -751,6 +1161,7 @@ if user["role"] == "admin":
             if st.button("🗑️ Удалить правило", use_container_width=True, key="delete_rule_btn"):
                 if del_id > 0:
                     result = execute_query("DELETE FROM mapping_rules WHERE id=%s", (int(del_id),), fetch=False)
+                    load_mapping_rules.clear()
                     if result is not None:  # Успешно удалено
                         st.success(f"Правило #{del_id} удалено!")
                         st.rerun()
@@ -778,16 +1189,20 @@ if user["role"] == "admin":
                         (field_name, field_type, now),
                         fetch=False
                     )
+                    _fields_registry.clear()
+                    _editor_bootstrap.clear()
                     ensure_column("data", field_name, field_type)
                     st.success(f"Поле '{field_name}' ({field_type}) добавлено.")
                     st.rerun()
         
         with c6:
             st.markdown("**Список полей**")
-            fields_df = execute_query("SELECT field, field_type, created_at FROM fields_registry ORDER BY created_at DESC")
+            fields_df, data_version = _editor_bootstrap()
             st.dataframe(fields_df, use_container_width=True, height=250)
         
-        st.markdown("**Редактирование/удаление поля**")
+        # Отступ кнопки удаления задаётся CSS по ключу виджета вместо отдельного <br>
+        st.markdown("<style>.st-key-field_delete_btn {margin-top: 1.75rem;}</style>"
+                    "**Редактирование/удаление поля**", unsafe_allow_html=True)
         c5a, c5b, c5c = st.columns(3)
         
         with c5a:
@@ -817,24 +1232,18 @@ if user["role"] == "admin":
                         st.rerun()
             
             with c5c:
-                st.markdown("<br>", unsafe_allow_html=True)
-                if st.button("🗑️ Удалить поле", use_container_width=True, type="secondary"):
-                    protected = ["id", "upload_id", "uploaded_by", "uploaded_at", "Год", "Месяц", "Код_клиента"]
-                    if field_to_edit in protected:
+                if st.button("🗑️ Удалить поле", use_container_width=True, type="secondary",
+                             key="field_delete_btn"):
+                    if field_to_edit in PROTECTED_FIELDS:
                         st.error(f"'{field_to_edit}' защищено от удаления.")
                     else:
                         delete_field_registry(field_to_edit)
                         st.success(f"Поле '{field_to_edit}' удалено из registry.")
                         st.rerun()
         
-        st.markdown("---")
+        st.markdown("---\n### 📝 Редактирование данных\n:gray[Изменение отдельных записей в таблице data]")
         
-        st.markdown("### 📝 Редактирование данных")
-        st.caption("Изменение отдельных записей в таблице data")
-        
-        all_data = execute_query(
-            "SELECT id, \"Год\", \"Месяц\", \"Сеть\", \"Наименование_товара_клиента\", uploaded_by FROM data ORDER BY id DESC LIMIT 100"
-        )
+        all_data = load_recent_data(data_version)
         
         if all_data.empty:
             st.info("Нет данных для редактирования.")
@@ -843,72 +1252,29 @@ if user["role"] == "admin":
             
             with c7:
                 st.markdown("**Список записей (последние 100)**")
-                st.dataframe(all_data, use_container_width=True, height=300)
+                st.dataframe(all_data, use_container_width=True, height=300, hide_index=True,
+                             column_order=RECENT_DATA_COLUMNS, key="preview_grid")
                 row_to_edit = st.number_input("ID записи", min_value=1, step=1, 
                                                value=int(all_data.iloc[0]["id"]), 
                                                key="row_edit_id")
                 
                 if st.button("📝 Загрузить для редактирования", use_container_width=True):
-                    row_data = get_data_row(row_to_edit)
+                    cols_in_table = set(table_columns("data"))
+                    row_fields = [f for f in _fields_registry() if f in cols_in_table
+                                  and f not in SYSTEM_FIELDS]
+                    row_data = get_data_row(row_to_edit, row_fields)
                     if not row_data.empty:
                         st.session_state.edit_row_id = row_to_edit
-                        st.session_state.edit_data = row_data.iloc[0].to_dict()
-                        st.rerun()
+                        # Снимок записи (baseline) и настройки колонок — один раз при загрузке;
+                        # правки хранит сам data_editor в виде дельты по изменённым ячейкам
+                        row = {k: None if pd.isna(v) else v for k, v in row_data.iloc[0].items()}
+                        st.session_state.edit_frame = _edit_frame(row_fields, row)
+                        st.session_state.edit_column_config = _edit_column_config(row_fields)
+                        # Без st.rerun(): панель справа рисуется ниже в этом же прогоне и уже видит запись
                     else:
                         st.error(f"ID {row_to_edit} не найден.")
             
             with c8:
-                if "edit_data" in st.session_state and st.session_state.edit_data:
-                    st.markdown(f"**Редактирование записи ID = {st.session_state.edit_row_id}**")
-                    
-                    registry_fields_edit = execute_query("SELECT field FROM fields_registry")["field"].tolist()
-                    updated_values = {}
-                    
-                    edit_fields = [f for f in registry_fields_edit 
-                                   if f in st.session_state.edit_data 
-                                   and f not in ["id", "upload_id", "uploaded_by", "uploaded_at"]]
-                    
-                    for i in range(0, len(edit_fields), 3):
-                        cols = st.columns(3)
-                        for j, field in enumerate(edit_fields[i:i+3]):
-                            with cols[j]:
-                                current_val = st.session_state.edit_data.get(field)
-                                
-                                if field in DEFAULT_NUMERIC_FIELDS:
-                                    new_val = st.number_input(
-                                        field, 
-                                        value=float(current_val) if current_val else 0.0, 
-                                        key=f"edit_{field}", 
-                                        format="%.2f"
-                                    )
-                                else:
-                                    new_val = st.text_input(
-                                        field, 
-                                        value=str(current_val) if current_val not in [None, "None", ""] else "", 
-                                        key=f"edit_{field}"
-                                    )
-                                
-                                if str(new_val) != str(current_val):
-                                    updated_values[field] = new_val
-                    
-                    col_save, col_cancel = st.columns(2)
-                    with col_save:
-                        if st.button("✅ Сохранить изменения", use_container_width=True, type="primary"):
-                            if updated_values:
-                                update_data_row(st.session_state.edit_row_id, updated_values)
-                                st.success(f"Запись #{st.session_state.edit_row_id} обновлена! Изменено полей: {len(updated_values)}")
-                                del st.session_state.edit_data
-                                del st.session_state.edit_row_id
-                                st.rerun()
-                            else:
-                                st.warning("Нет изменений для сохранения.")
-                    
-                    with col_cancel:
-                        if st.button("❌ Отмена", use_container_width=True):
-                            del st.session_state.edit_data
-                            del st.session_state.edit_row_id
-                            st.rerun()
-                else:
-                    st.info("👈 Выберите ID записи слева и нажмите 'Загрузить для редактирования'")
+                render_edit_panel()
 
 st.caption("Дефолтный админ: admin@local / admin")
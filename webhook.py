@@ -1,26 +1,85 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
-import subprocess
-import threading
+import asyncio
+import hmac
+import logging
+import os
+import orjson
 
-app = FastAPI()
+DEPLOY_CMD = [
+    'powershell', '-NoProfile', '-NonInteractive', '-ExecutionPolicy', 'Bypass',
+    '-File', r'C:\ПРОЕКТЫ\elta-import\deploy.ps1'
+]
 
-@app.post("/webhook") 
+# Секрет webhook из настроек репозитория GitHub; без него все запросы отклоняются
+WEBHOOK_SECRET = os.getenv("GITHUB_WEBHOOK_SECRET", "").encode()
+
+log = logging.getLogger(__name__)
+
+# Есть необработанный push: воркер запустит deploy, пока событие взведено
+_deploy_requested = asyncio.Event()
+# Идёт ли deploy прямо сейчас
+_deploying = False
+
+
+async def run_deploy():
+    # Процесс ждём на event loop, без отдельного потока; вывод не копится
+    # в памяти процесса — deploy.ps1 сам пишет deploy.log
+    proc = await asyncio.create_subprocess_exec(
+        *DEPLOY_CMD, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+    )
+    await proc.wait()
+
+
+async def deploy_worker():
+    """Один воркер на процесс: deploy идут по очереди, push'и во время deploy склеиваются в один следующий"""
+    global _deploying
+    while True:
+        await _deploy_requested.wait()
+        _deploy_requested.clear()
+        _deploying = True
+        try:
+            await run_deploy()
+        except Exception:
+            log.exception("deploy failed")
+        finally:
+            _deploying = False
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    worker = asyncio.create_task(deploy_worker())
+    yield
+    worker.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.post("/webhook")
 async def github_webhook(request: Request):
-    data = await request.json()
+    body = await request.body()
+    
+    # Подпись проверяем до разбора JSON: чужой запрос стоит одного HMAC
+    signature = request.headers.get('X-Hub-Signature-256', '')
+    expected = 'sha256=' + hmac.new(WEBHOOK_SECRET, body, 'sha256').hexdigest()
+    if not WEBHOOK_SECRET or not hmac.compare_digest(signature, expected):
+        return JSONResponse({'status': 'forbidden'}, status_code=403)
+    
+    # orjson вместо json.loads: тело GitHub-события парсится в разы быстрее
+    data = orjson.loads(body)
     
     if data.get('ref') == 'refs/heads/main':
-        # Запускаем deploy в фоне
-        threading.Thread(
-            target=lambda: subprocess.run([
-                'powershell', '-ExecutionPolicy', 'Bypass', 
-                '-File', r'C:\ПРОЕКТЫ\elta-import\deploy.ps1'
-            ], capture_output=True)
-        ).start()
-        return JSONResponse({'status': 'deploy_started'})
+        # Deploy уже идёт или ждёт: новый push подхватит следующий git pull
+        busy = _deploying or _deploy_requested.is_set()
+        _deploy_requested.set()
+        return JSONResponse({'status': 'deploy_queued' if busy else 'deploy_started'}, status_code=202)
     
     return JSONResponse({'status': 'ignored'})
 
 if __name__ == '__main__':
     import uvicorn
-    uvicorn.run(app, host='0.0.0.0', port=8502)
\ No newline at end of file
+    # httptools вместо h11; uvloop (loop='auto') берётся там, где он есть — на Windows его нет.
+    # Воркер один: очередь deploy живёт в памяти процесса
+    uvicorn.run(app, host='0.0.0.0', port=8502, loop='auto', http='httptools', workers=1)
\ No newline at end of file